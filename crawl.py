@@ -1,117 +1,382 @@
+import argparse
+import codecs
+import contextlib
+import email.message
 import functools
-import hashlib
-import json
-import shutil
-import sys
-from collections import deque
+import html
+import importlib.util
+import io
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from collections.abc import Iterator, Mapping
+from concurrent.futures import ThreadPoolExecutor
+from html.entities import html5 as html5_entities
 from pathlib import Path
-from urllib.parse import urljoin, urlparse
+from typing import Literal, NamedTuple, get_args
+from urllib.parse import SplitResult, urljoin, urlparse, urlsplit
 
+import orjson
 import requests
-from bs4 import BeautifulSoup
+from pybloom_live import ScalableBloomFilter
+from requests.adapters import HTTPAdapter
+from selectolax.lexbor import LexborHTMLParser
+from urllib3.util import Retry
 
 from logger import setup_logger
 
 log = setup_logger(__name__)
 
 MAX_PAGES = 10
+# extract links with a full HTML parser; set to False to scan for them with
+# the much cheaper `HREF_PATTERN` instead
+PARSE_LINKS_WITH_HTML_PARSER = True
+# href attribute of an anchor tag, with a double quoted, single quoted or
+# unquoted value. Quoted values of the other attributes are skipped, so a
+# `>` or `href=` in them isn't mistaken for the end of the tag or the link.
+HREF_PATTERN = re.compile(
+    r"""<a(?=[\s/>])(?:[^\s>"']++|"[^"]*+"|'[^']*+'|\s++(?!href\s*+=))*+"""
+    r"""\s++href\s*+=\s*+(?:"([^"]*+)"|'([^']*+)'|([^\s>]++))""",
+    re.IGNORECASE,
+)
+# character reference in an attribute value: decimal, hexadecimal or named,
+# with an optional trailing semicolon
+CHARACTER_REFERENCE_PATTERN = re.compile(
+    r"&(#[0-9]+;?|#[xX][0-9a-fA-F]+;?|[A-Za-z][A-Za-z0-9]*;?)"
+)
+# file formats the pages metadata can be saved in
+MetadataFormat = Literal["json", "parquet"]
+# pyarrow is only installed with the `parquet` extra
+PYARROW_MISSING_MESSAGE = (
+    "Parquet output requires pyarrow, install it with "
+    "`poetry install --extras parquet`"
+)
+# links that `urljoin` doesn't return as they are: it normalizes dot
+# segments, drops tabs, newlines and an empty query, fragment or `;`
+# parameters, and falls back to the page URL for an empty host
+NORMALIZED_LINK_PATTERN = re.compile(
+    r"/\.|[\t\r\n;]|\?#|[?#]$|^(?:https?:)?//(?:[/?#]|$)"
+)
+# number of pages fetched or saved concurrently
+MAX_WORKERS = 32
+# sizing of the Bloom filter tracking visited URLs; it grows past the
+# initial capacity on its own while keeping the false positive rate
+VISITED_URLS_CAPACITY = 100_000
+VISITED_URLS_ERROR_RATE = 1e-6
+# (connect, read) timeouts in seconds for every HTTP request
+REQUEST_TIMEOUT = (5, 30)
+# pages larger than this are not downloaded
+MAX_CONTENT_BYTES = 10 * 1024 * 1024
+# size of the chunks response bodies are read in
+CHUNK_SIZE = 64 * 1024
+
+# politeness limit for requests sent to the same host
+MAX_REQUESTS_PER_SECOND_PER_HOST = 10
+
+# share one session across all fetches so connections to the same host
+# are kept alive and reused instead of re-established per URL
+_session = requests.Session()
+# Size the connection pool for the worker threads, so concurrent requests
+# to a host don't queue up for a free connection, and retry transient
+# failures with exponential backoff
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+    ),
+)
+_session.mount("http://", _adapter)
+_session.mount("https://", _adapter)
+
+# send times of the latest requests to each host, see `wait_for_host`
+_host_request_times: defaultdict[str, deque[float]] = defaultdict(
+    lambda: deque(maxlen=MAX_REQUESTS_PER_SECOND_PER_HOST)
+)
+_host_request_times_lock = threading.Lock()
+
+
+def wait_for_host(url: str) -> None:
+    """
+    Block until a request to the host of a URL may be sent.
+
+    At most `MAX_REQUESTS_PER_SECOND_PER_HOST` requests are sent to the same
+    host within any one second window. The send time is reserved while
+    holding the lock, but the waiting happens outside of it, so threads
+    fetching from other hosts are never held up.
+
+    Args:
+        url (str): The URL about to be requested.
+    """
+    host = urlparse(url).netloc
+    with _host_request_times_lock:
+        request_times = _host_request_times[host]
+        now = time.monotonic()
+        send_at = now
+        if len(request_times) == request_times.maxlen:
+            # the oldest of the latest requests must be a second old
+            send_at = max(now, request_times[0] + 1)
+        request_times.append(send_at)
+    time.sleep(send_at - now)
+
+
+class PageRef(NamedTuple):
+    """
+    A page URL found while crawling.
+
+    A crawl can collect a lot of these, and a tuple takes considerably less
+    memory than a dict with the same three keys.
+
+    Attributes:
+        url (str): The URL of the page.
+        page (str): The URL of the page where the URL was found.
+        depth (int): The depth at which the URL was found relative to the starting URL.
+    """
+
+    url: str
+    page: str
+    depth: int
 
 
-@functools.lru_cache(maxsize=500)
-def fetch_html_content(url: str) -> str | None:
+class PageContent(NamedTuple):
+    """
+    The body of a fetched page.
+
+    Attributes:
+        content (bytes): The body exactly as it was received.
+        encoding (str): The encoding used to decode `content` for extracting links.
+    """
+
+    content: bytes
+    encoding: str
+
+    def text(self) -> str:
+        """
+        Decode the body, replacing any bytes that are invalid in `encoding`.
+        """
+        return self.content.decode(self.encoding, errors="replace")
+
+
+def get_content_encoding(content_type: str) -> str:
+    """
+    Get the charset declared in a Content-Type header.
+
+    `requests` assumes ISO-8859-1 for `text/*` responses without a charset,
+    which garbles the UTF-8 most such pages are actually in, so fall back to
+    UTF-8 instead.
+
+    Args:
+        content_type (str): The value of the Content-Type header.
+
+    Returns:
+        str: The name of the declared encoding, or 'utf-8' if there is none
+        or it is unknown.
+    """
+    message = email.message.Message()
+    message["Content-Type"] = content_type
+    charset = message.get_content_charset()
+    if charset:
+        try:
+            return codecs.lookup(charset).name
+        except LookupError:
+            pass
+    return "utf-8"
+
+
+def fetch_html_content(url: str) -> PageContent | None:
     """
     Fetch HTML content for a given URL.
 
+    The body is read in chunks and the download is abandoned as soon as it
+    grows past `MAX_CONTENT_BYTES`, so a huge page can't exhaust memory.
+    Requests to the same host are throttled by `wait_for_host`.
+
     Args:
         url (str): The URL from which to fetch the HTML content.
 
     Returns:
-        str: The raw HTML content of the page.
+        PageContent: The raw body of the page and its encoding, or None if
+        the request failed or the page is too large.
     """
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.text
+        wait_for_host(url)
+        with _session.get(url, stream=True, timeout=REQUEST_TIMEOUT) as response:
+            response.raise_for_status()
+            chunks = []
+            total_bytes = 0
+            for chunk in response.iter_content(CHUNK_SIZE):
+                total_bytes += len(chunk)
+                if total_bytes > MAX_CONTENT_BYTES:
+                    log.error(
+                        "Skipping %s: content exceeds %d bytes", url, MAX_CONTENT_BYTES
+                    )
+                    return None
+                chunks.append(chunk)
+            return PageContent(
+                b"".join(chunks),
+                get_content_encoding(response.headers.get("Content-Type", "")),
+            )
     except requests.exceptions.RequestException as exc:
-        log.error(f"Failed to fetch HTML content from {url}: {exc}")
+        log.error("Failed to fetch HTML content from %s: %s", url, exc)
         return None
 
 
-def extract_page_urls(html_content: str, url: str, current_depth: int) -> list[dict]:
+def join_url(url: str, split_url: SplitResult, link: str) -> str:
     """
-    Parse HTML content to extract page URLs.
+    Resolve a link found on a page into an absolute URL.
+
+    `urljoin` re-parses the page URL for every link, even though it is the
+    same for all links on a page. Instead, the page URL is split once and
+    the common kinds of links (absolute, scheme-relative, root-relative,
+    query and fragment only) are resolved from its parts directly, as long
+    as `urljoin` would return them unchanged. All other links, e.g. with dot
+    segments or an empty query or fragment, still go through `urljoin`.
 
     Args:
-        html_content (str): The raw HTML content.
-        url (str): The URL from which the HTML content was fetched.
-        current_depth (int): The current depth of the URL being processed.
+        url (str): The URL of the page the link was found on.
+        split_url (SplitResult): `url` split with `urlsplit`.
+        link (str): The href value to resolve.
 
     Returns:
-        A list of dictionaries, where each dictionary contains the
-        following keys:
-        - 'url': The URL of the page.
-        - 'page': The URL of the page where the URL was found.
-        - 'depth': The depth at which the URL was found relative to the starting URL.
-    """
-    collected_pages = [
-        {
-            "url": urljoin(url, a["href"]),
-            "page": url,
-            "depth": current_depth,
-        }
-        for a in BeautifulSoup(html_content, "html.parser").find_all("a")
-        if "href" in a.attrs
-    ]
-    return collected_pages[:MAX_PAGES]
+        str: The absolute URL the link points to.
+    """
+    # leave links that `urljoin` would normalize to it
+    if not NORMALIZED_LINK_PATTERN.search(link):
+        if link.startswith(("http://", "https://")):
+            return link
+        if link.startswith("//"):
+            return f"{split_url.scheme}:{link}"
+        if link.startswith("/"):
+            return f"{split_url.scheme}://{split_url.netloc}{link}"
+        if link.startswith("?"):
+            return f"{split_url.scheme}://{split_url.netloc}{split_url.path}{link}"
+        if link.startswith("#"):
+            query = f"?{split_url.query}" if split_url.query else ""
+            return (
+                f"{split_url.scheme}://{split_url.netloc}{split_url.path}{query}{link}"
+            )
+    return urljoin(url, link)
+
+
+def unescape_attribute(value: str) -> str:
+    """
+    Decode the character references in an HTML attribute value.
+
+    `html.unescape` decodes legacy named references that lack a semicolon
+    anywhere, so `?page=2&section=news` would become `?page=2§ion=news`.
+    HTML parsers leave those alone in attribute values when they are
+    followed by `=` or an alphanumeric character, and so does this.
+
+    Args:
+        value (str): The raw attribute value.
+
+    Returns:
+        str: The attribute value with its character references decoded.
+    """
+
+    def replace(match: re.Match[str]) -> str:
+        reference = match.group(1)
+        if reference.startswith("#"):
+            return html.unescape(match.group(0))
+        if reference.endswith(";"):
+            # only decoded if the whole name is known, `&ampx;` stays as is
+            return html5_entities.get(reference, match.group(0))
+        # without a semicolon, only a legacy name spanning the whole
+        # alphanumeric run and not followed by `=` is decoded
+        if reference in html5_entities and value[match.end() : match.end() + 1] != "=":
+            return html5_entities[reference]
+        return match.group(0)
+
+    return CHARACTER_REFERENCE_PATTERN.sub(replace, value)
 
 
 def extract_links(html_content: str, url: str) -> list[str]:
     """
     Parse HTML content to extract links.
 
+    By default the page is parsed with a full HTML parser. Unset
+    `PARSE_LINKS_WITH_HTML_PARSER` to scan for the href values with
+    `HREF_PATTERN` instead, which is much cheaper than building a DOM just
+    to read one attribute. The scan doesn't know which parts of the page are
+    markup, though, so it also picks up links in comments, scripts and
+    elements like `<textarea>`.
+
     Args:
         html_content (str): The raw HTML content.
         url (str): The URL from which the HTML content was fetched.
 
     Returns:
-        A list of URL strings from the href attributes of anchor tags.
+        A list of unique URL strings from the href attributes of anchor tags,
+        in the order they first appear on the page.
     """
-    soup = BeautifulSoup(html_content, "html.parser")
-    return [a["href"] for a in soup.find_all("a") if "href" in a.attrs]
+    if PARSE_LINKS_WITH_HTML_PARSER:
+        tree = LexborHTMLParser(html_content)
+        # a bare `<a href>` has no value, treat it as an empty link
+        links = (a.attributes["href"] or "" for a in tree.css("a[href]"))
+    else:
+        # only one of the quoting alternatives matches, the others are None
+        links = (
+            match.group(1) or match.group(2) or match.group(3) or ""
+            for match in HREF_PATTERN.finditer(html_content)
+        )
+        # decode character references by the rules for attribute values
+        links = (unescape_attribute(link) if "&" in link else link for link in links)
+    # Pages often repeat the same link (navigation bars, footers). `dict`
+    # drops the duplicates while keeping the order, so they are never
+    # resolved or queued more than once.
+    return list(dict.fromkeys(links))
 
 
-def hash_url(url: str) -> int:
+def extract_page_urls(links: list[str], url: str, current_depth: int) -> list[PageRef]:
     """
-    Compute the SHA-256 hash of a URL and return it as an integer.
+    Build page URLs from links already extracted with `extract_links`.
 
-    Hashing the URL allows for efficient storage and comparison in the `visited_urls` set by reducing memory usage compared to storing full URL strings.
+    Taking the extracted links instead of the raw HTML means each page is
+    parsed only once, even though both the page URLs and the links to crawl
+    next are needed.
 
     Args:
-        url (str): The URL string to be hashed.
+        links (list of str): The href values found on the page.
+        url (str): The URL from which the links were extracted.
+        current_depth (int): The current depth of the URL being processed.
 
     Returns:
-        int: The integer representation of the SHA-256 hash of the URL.
+        A list of `PageRef` tuples, one for each page URL found.
     """
-    return int(hashlib.sha256(url.encode()).hexdigest(), 16)
+    split_url = urlsplit(url)
+    # only the first `MAX_PAGES` links are kept, so don't resolve the rest
+    return [
+        PageRef(join_url(url, split_url, link), url, current_depth)
+        for link in links[:MAX_PAGES]
+    ]
 
 
-def fetch_pages_from_url(url: str, current_depth: int, max_depth: int) -> list[dict]:
+def fetch_pages_from_url(
+    url: str,
+    current_depth: int,
+    max_depth: int,
+    page_contents: dict[str, bytes] | None = None,
+) -> list[PageRef]:
     """
     Fetch pages from a given URL and its linked pages up to a specified depth.
 
     Note:
         We are using BFS algorithm to crawl pages, avoiding processing the same URL multiple times.
+        All URLs of a BFS level are fetched concurrently on a thread pool before the next level is expanded.
 
     Args:
         url (str): The starting URL from which to fetch pages.
         current_depth (int): The current depth of the URL being processed.
         max_depth (int): The maximum depth to crawl from the starting URL.
+        page_contents (dict, optional): If given, the raw body of every
+            fetched page is stored in it by URL, so it can be saved later
+            without downloading it again.
 
     Returns:
-        A list of dictionaries, each containing the following keys:
-        - 'url': The URL of the page.
-        - 'html': The raw HTML content of the page.
-        - 'depth': The depth at which the page was found relative to the starting URL.
+        A list of `PageRef` tuples for all page URLs found while crawling.
 
         Return an empty list if no pages are found or in case of a request failure.
     """
@@ -119,35 +384,54 @@ def fetch_pages_from_url(url: str, current_depth: int, max_depth: int) -> list[d
         return []
 
     pages = []
-    visited_urls_hashes = set()
-    queue = deque([(url, current_depth)])
-
-    while queue:
-        current_url, current_depth = queue.popleft()
-        current_url_hash = hash_url(current_url)
-        # Skip processing if the URL has already been visited
-        if current_url_hash in visited_urls_hashes:
-            continue
-        visited_urls_hashes.add(current_url_hash)
-
-        log.info(f"Fetching pages from {current_url} at depth {current_depth}")
-        html_content = fetch_html_content(current_url)
-        collected_pages = extract_page_urls(
-            html_content,
-            current_url,
-            current_depth,
-        )
-        pages.extend(collected_pages)
-
-        # Stop crawling if current depth reaches maximum depth
-        if current_depth == max_depth:
-            continue
-        links = extract_links(html_content, current_url)
-        for link in links:
-            page_url = urljoin(current_url, link)
+    # A Bloom filter only stores a few bits per URL instead of the full
+    # string. A rare false positive means skipping a page, never a refetch.
+    visited_urls = ScalableBloomFilter(
+        initial_capacity=VISITED_URLS_CAPACITY,
+        error_rate=VISITED_URLS_ERROR_RATE,
+    )
+    # URLs are marked as visited as soon as they are queued, so every level
+    # only ever holds URLs that have not been seen before
+    visited_urls.add(url)
+    level = [url]
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        while level:
+            for level_url in level:
+                log.info("Fetching pages from %s at depth %d", level_url, current_depth)
+
+            next_level = []
+            # `map` yields results in the same order as `level`
+            fetched_pages = executor.map(fetch_html_content, level)
+            for current_url, page_content in zip(level, fetched_pages):
+                if page_content is None:
+                    continue
+                if page_contents is not None:
+                    page_contents[current_url] = page_content.content
+                links = extract_links(page_content.text(), current_url)
+                collected_pages = extract_page_urls(
+                    links,
+                    current_url,
+                    current_depth,
+                )
+                pages.extend(collected_pages)
+
+                # Stop crawling if current depth reaches maximum depth
+                if current_depth >= max_depth:
+                    continue
+                split_url = urlsplit(current_url)
+                for link in links:
+                    page_url = join_url(current_url, split_url, link)
+                    # Skip URLs that have already been visited or queued
+                    if page_url in visited_urls:
+                        continue
+                    visited_urls.add(page_url)
+                    next_level.append(page_url)
+
+            level = next_level
             # `current_depth` incremented by 1
-            # indicating it's now one level deeper.
-            queue.append((page_url, current_depth + 1))
+            # indicating the next level is one level deeper.
+            current_depth += 1
 
     return pages
 
@@ -168,63 +452,187 @@ def extract_filename_from_url(url: str) -> str:
     return Path(path).name
 
 
-def save_pages_metadata(pages: list[dict]) -> None:
+@contextlib.contextmanager
+def open_atomically(file_path: Path) -> Iterator[io.BufferedWriter]:
+    """
+    Open a file for binary writing and replace it atomically once done.
+
+    The content goes to a temporary file next to `file_path`, which is only
+    moved into place when it is complete. Readers never see a half written
+    file, and an existing file doesn't have to be deleted first.
+
+    Args:
+        file_path (Path): The path of the file to write.
+
+    Yields:
+        The binary file object of the temporary file.
+    """
+    # the thread id keeps pages that map to the same file name from
+    # sharing a temporary file while they are saved concurrently
+    tmp_path = file_path.with_name(f"{file_path.name}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, "wb") as fp:
+            yield fp
+        tmp_path.replace(file_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def save_pages_metadata(
+    pages: list[PageRef], file_format: MetadataFormat = "json"
+) -> None:
     """
-    Save page metadata to a JSON file.
+    Save page metadata to a JSON or Parquet file.
+
+    JSON is easy to read, but for large crawls Parquet is much smaller on
+    disk and faster to load for analysis. Each field is stored as a
+    compressed column, and the `page` and `depth` columns repeat a lot.
 
     Args:
-        pages (list of dict): A list of dictionaries where each dictionary contains the 'url', 'depth', and 'html' keys.
+        pages (list of PageRef): The page URLs found while crawling.
+        file_format (str): Either 'json' or 'parquet'.
+
+    Raises:
+        ValueError: If `file_format` is not a known format.
+        ImportError: If `file_format` is 'parquet' but pyarrow isn't
+            installed.
     """
+    if file_format not in get_args(MetadataFormat):
+        raise ValueError(f"Unknown metadata format: {file_format!r}")
+    if file_format == "parquet":
+        # pyarrow is large, only load it when Parquet output is asked for,
+        # and before any metadata from a previous run is removed
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as exc:
+            raise ImportError(PYARROW_MISSING_MESSAGE) from exc
+
     pages_dir = Path("pages")
-    if pages_dir.exists():
-        shutil.rmtree(pages_dir)
-    # don't raise an error if directory already exists
-    pages_dir.mkdir(exist_ok=True)
+    # don't raise an error if directory already exists, files from a
+    # previous run are overwritten rather than deleted up front
+    pages_dir.mkdir(parents=True, exist_ok=True)
 
     if not pages:
+        # still write an empty file, so metadata from a previous run can't
+        # be mistaken for the result of this one
         log.info("No pages to save metadata for.")
+
+    # likewise, remove metadata a previous run saved in another format
+    for other_format in get_args(MetadataFormat):
+        if other_format != file_format:
+            (pages_dir / f"pages_metadata.{other_format}").unlink(missing_ok=True)
+
+    if file_format == "parquet":
+        # the schema is spelled out, since it can't be inferred without pages
+        schema = pa.schema(
+            [("url", pa.string()), ("page", pa.string()), ("depth", pa.int64())]
+        )
+        table = pa.table(
+            {
+                field: [getattr(page, field) for page in pages]
+                for field in PageRef._fields
+            },
+            schema=schema,
+        )
+        with open_atomically(pages_dir / "pages_metadata.parquet") as fp:
+            pq.write_table(table, fp, compression="zstd")
         return
 
-    metadata = {"pages": pages}
-    with open(pages_dir / "pages_metadata.json", "w") as fp:
-        json.dump(metadata, fp, indent=4)
+    # Write the pages one by one instead of serializing `{"pages": pages}`
+    # as a whole, so only a single page is encoded in memory at a time.
+    # The file is identical to `orjson.dumps` with `OPT_INDENT_2` output.
+    with open_atomically(pages_dir / "pages_metadata.json") as fp:
+        fp.write(b'{\n  "pages": [')
+        for i, page in enumerate(pages):
+            fp.write(b",\n    " if i else b"\n    ")
+            encoded_page = orjson.dumps(page._asdict(), option=orjson.OPT_INDENT_2)
+            # nest the page two levels deep, matching the array indentation
+            fp.write(encoded_page.replace(b"\n", b"\n    "))
+        fp.write(b"\n  ]\n}" if pages else b"]\n}")
+
+
+def save_page_locally(
+    page: PageRef, page_contents: Mapping[str, bytes] | None = None
+) -> None:
+    """
+    Save a single fetched page to a local file.
 
+    The page is written byte for byte as it was received. Pages that weren't
+    fetched while crawling, e.g. linked files, are downloaded and copied to
+    disk chunk by chunk, so they aren't limited by `MAX_CONTENT_BYTES`.
 
-def save_pages_locally(pages: list[dict]) -> None:
+    Args:
+        page (PageRef): The page to save.
+        page_contents (mapping, optional): Raw bodies of pages fetched while
+            crawling by URL, saved without downloading them again.
+    """
+    page_name = extract_filename_from_url(page.url)
+    file_path = Path("pages", f"{page_name}.html")
+    content = page_contents.get(page.url) if page_contents else None
+    if content is not None:
+        with open_atomically(file_path) as fp:
+            fp.write(content)
+        log.info("Saved page: %s", page.url)
+        return
+    try:
+        wait_for_host(page.url)
+        with _session.get(page.url, stream=True, timeout=REQUEST_TIMEOUT) as page_data:
+            page_data.raise_for_status()
+            with open_atomically(file_path) as fp:
+                for chunk in page_data.iter_content(CHUNK_SIZE):
+                    fp.write(chunk)
+    except requests.exceptions.RequestException as exc:
+        log.error("Failed to save page %s: %s", page.url, exc)
+        return
+    log.info("Saved page: %s", page.url)
+
+
+def save_pages_locally(
+    pages: list[PageRef], page_contents: Mapping[str, bytes] | None = None
+) -> None:
     """
     Save the fetched pages to local files.
 
+    Pages are saved concurrently on a thread pool, each URL only once.
+
     Args:
-        pages (list of dict): A list of dictionaries where each dictionary contains the 'url' and 'html' keys.
-    """
-    # tracks downloaded pages to avoid duplicates
-    downloaded_pages = set()
-    for page in pages:
-        if page["url"] in downloaded_pages:
-            # skip duplicate pages
-            continue
-        try:
-            with requests.get(page["url"], stream=True) as page_data:
-                page_name = extract_filename_from_url(page["url"])
-                file_path = Path("pages", f"{page_name}.html")
-                with open(file_path, "wb") as fp:
-                    fp.write(page_data.content)
-                log.info(f"Saved page: {page['url']}")
-                downloaded_pages.add(page["url"])
-        except requests.exceptions.RequestException as exc:
-            log.error(f"Failed to save page {page['url']}: {exc}")
+        pages (list of PageRef): The pages to save.
+        page_contents (mapping, optional): Raw bodies of pages fetched while
+            crawling by URL, as filled in by `fetch_pages_from_url`.
+    """
+    # drop duplicate pages before submitting them to the pool
+    unique_pages = {page.url: page for page in pages}.values()
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # consume the results so exceptions raised in workers propagate
+        list(
+            executor.map(
+                functools.partial(save_page_locally, page_contents=page_contents),
+                unique_pages,
+            )
+        )
 
 
 def main() -> None:
-    # check if only two command-line arguments are provided
-    if len(sys.argv) != 3:
-        log.error("Usage: <script_name> <start_url> <depth>")
-        sys.exit(1)
-
-    _, start_url, depth = sys.argv
-    pages = fetch_pages_from_url(start_url, 1, int(depth))
-    save_pages_metadata(pages)
-    save_pages_locally(pages)
+    parser = argparse.ArgumentParser(description="Crawl a website and save pages")
+    parser.add_argument("start_url", help="The URL to start crawling from")
+    parser.add_argument("depth", type=int, help="The maximum depth of links to follow")
+    parser.add_argument(
+        "--format",
+        choices=get_args(MetadataFormat),
+        default="json",
+        help="The file format of the pages metadata (default: json)",
+    )
+    args = parser.parse_args()
+    # fail before crawling rather than when the metadata is saved
+    if args.format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        parser.error(PYARROW_MISSING_MESSAGE)
+
+    page_contents: dict[str, bytes] = {}
+    pages = fetch_pages_from_url(args.start_url, 1, args.depth, page_contents)
+    save_pages_metadata(pages, args.format)
+    save_pages_locally(pages, page_contents)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,14 @@
+import functools
 import logging
 
 
+@functools.lru_cache(maxsize=None)
 def setup_logger(name: str) -> logging.Logger:
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - [%(levelname)s]: %(message)s",
-        datefmt="%d-%b-%y %H:%M:%S",
-    )
+    # only configure the root logger once, later calls just reuse it
+    if not logging.root.handlers:
+        logging.basicConfig(
+            level=logging.INFO,
+            format="%(asctime)s - [%(levelname)s]: %(message)s",
+            datefmt="%d-%b-%y %H:%M:%S",
+        )
     return logging.getLogger(name)
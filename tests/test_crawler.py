@@ -1,10 +1,24 @@
-import json
+import subprocess
+import sys
 from pathlib import Path
+from urllib.parse import urljoin, urlsplit
 
+import orjson
 import pytest
 import requests_mock
 
-from crawl import fetch_pages_from_url, save_pages_locally, save_pages_metadata
+from crawl import (
+    PageRef,
+    extract_links,
+    extract_page_urls,
+    fetch_html_content,
+    fetch_pages_from_url,
+    join_url,
+    open_atomically,
+    save_pages_locally,
+    save_pages_metadata,
+    wait_for_host,
+)
 
 
 @pytest.fixture
@@ -38,9 +52,9 @@ def assert_pages_start_with(pages, prefix):
     Check that each page URL in the list starts with the given prefix.
     """
     for page in pages:
-        assert page["url"].startswith(
+        assert page.url.startswith(
             prefix
-        ), f"Page URL {page['url']} does not start with {prefix}"
+        ), f"Page URL {page.url} does not start with {prefix}"
 
 
 def test_fetch_pages_single_page(mock_response):
@@ -57,11 +71,7 @@ def test_fetch_pages_single_page(mock_response):
         assert len(pages) == 4
         # helper function to assert the condition for each page URL
         assert_pages_start_with(
-            [
-                page
-                for page in pages
-                if page["url"] != "http://example.com/nextpage.html"
-            ],
+            [page for page in pages if page.url != "http://example.com/nextpage.html"],
             "http://example.com/page",
         )
 
@@ -83,6 +93,192 @@ def test_handling_maximum_depth(mock_response):
         assert len(pages) == 8
 
 
+def test_fetch_pages_skips_visited_urls(mock_response):
+    """
+    Check that a URL linked from several pages, or from itself, is only
+    fetched once.
+    """
+    with requests_mock.Mocker() as m:
+        m.get("http://example.com/testpage.html", text=mock_response)
+        m.get("http://example.com/page1.html", text="<html>Page 1 content</html>")
+        m.get("http://example.com/page2.html", text="<html>Page 2 content</html>")
+        m.get("http://example.com/page3.html", text="<html>Page 3 content</html>")
+        nextpage = m.get("http://example.com/nextpage.html", text=mock_response)
+        # "next page" links back to itself and the pages already fetched
+        fetch_pages_from_url("http://example.com/testpage.html", 1, 3)
+        assert nextpage.call_count == 1
+        assert m.call_count == 5
+
+
+def test_fetch_pages_duplicate_links():
+    """
+    Check that a link repeated on the same page is only collected once.
+    """
+    html = """
+    <html>
+        <body>
+            <a href="/page1.html">Page 1</a>
+            <a href="/page1.html">Page 1 again</a>
+            <a href="http://example.com/page2.html">Page 2</a>
+        </body>
+    </html>
+    """
+    with requests_mock.Mocker() as m:
+        m.get("http://example.com/duplicates.html", text=html)
+        pages = fetch_pages_from_url("http://example.com/duplicates.html", 1, 1)
+        assert [page.url for page in pages] == [
+            "http://example.com/page1.html",
+            "http://example.com/page2.html",
+        ]
+
+
+def test_extract_links_matches_html_parser(mocker):
+    """
+    Check that scanning for href values finds the same links in anchor tags
+    as a full HTML parser.
+    """
+    html = """
+    <html>
+        <body>
+            <a href="/page1.html">Double quoted</a>
+            <a class="nav" href='/page2.html'>Single quoted</a>
+            <A HREF=/page3.html>Unquoted</A>
+            <a title="no link">No href</a>
+            <a href="/search?q=1&amp;page=2">Character reference</a>
+            <a href="/list?page=2&section=news">Legacy name before "="</a>
+            <a href="/shop?region=us&currency=usd">Legacy names before "="</a>
+            <a href="/about?year=&copy2024">Legacy name before a digit</a>
+            <a href="/about?title=&copy 2024">Legacy name on its own</a>
+            <a href="/search?q=&#38;&#x26;&notin;">Numeric and named references</a>
+            <a
+                id="multiline" href="http://example.com/page4.html">Multi-line</a>
+            <a href="">Empty</a>
+            <a title="see href=/bad" href="/page5.html">href in another value</a>
+            <a title="a>b" href="/page6.html">">" in another value</a>
+            <abbr href="/not-a-link.html">Not an anchor</abbr>
+        </body>
+    </html>
+    """
+    links = extract_links(html, "http://example.com/")
+    mocker.patch("crawl.PARSE_LINKS_WITH_HTML_PARSER", False)
+    assert links == extract_links(html, "http://example.com/")
+
+
+def test_extract_links_skips_text_that_isnt_markup():
+    """
+    Check that links in comments, scripts and other text that isn't parsed as
+    markup are not extracted.
+    """
+    html = """
+    <html>
+        <head>
+            <script>document.write('<a href="/script.html">Script</a>');</script>
+        </head>
+        <body>
+            <!-- <a href="/comment.html">Comment</a> -->
+            <textarea><a href="/textarea.html">Textarea</a></textarea>
+            <a href="/page1.html">Page 1</a>
+        </body>
+    </html>
+    """
+    assert extract_links(html, "http://example.com/") == ["/page1.html"]
+
+
+def test_extract_page_urls_max_pages(mocker):
+    """
+    Check that only the first `MAX_PAGES` links of a page are collected.
+    """
+    mocker.patch("crawl.MAX_PAGES", 2)
+    links = ["/page1.html", "/page2.html", "/page3.html"]
+    pages = extract_page_urls(links, "http://example.com/testpage.html", 1)
+    assert [page.url for page in pages] == [
+        "http://example.com/page1.html",
+        "http://example.com/page2.html",
+    ]
+
+
+def test_fetch_html_content_too_large(requests_mock, mocker):
+    """
+    Check that pages larger than `MAX_CONTENT_BYTES` are not returned.
+    """
+    mocker.patch("crawl.MAX_CONTENT_BYTES", 16)
+    requests_mock.get("http://example.com/large.html", text="<html>" + "a" * 32)
+    requests_mock.get("http://example.com/small.html", text="<html></html>")
+    assert fetch_html_content("http://example.com/large.html") is None
+    assert fetch_html_content("http://example.com/small.html") == (
+        b"<html></html>",
+        "utf-8",
+    )
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "http://example.com/docs/testpage.html",
+        "https://example.com:8080/docs/?query=0#top",
+        "https://example.com",
+    ],
+)
+@pytest.mark.parametrize(
+    "link",
+    [
+        "http://example.org/page.html",
+        "https://example.org",
+        "https://example.org/#",
+        "https://",
+        "/page1.html",
+        "/page#",
+        "/page?",
+        "/page?#section",
+        "/page;",
+        "/page;params",
+        "/page1.html?query=1#section",
+        "//cdn.example.org/page.html",
+        "//cdn.example.org",
+        "//cdn.example.org/page.html#",
+        "//",
+        "///page.html",
+        "//?query=1",
+        "//#section",
+        "page1.html",
+        "../page1.html",
+        "/docs/../page1.html",
+        "/page\n1.html",
+        "http://example.org/page\t1.html",
+        "//cdn.example.org/page\r\n1.html",
+        "?query=\n1",
+        "#sec\ttion",
+        "?query=1",
+        "?query=1#section",
+        "?query=1#",
+        "?#section",
+        "?",
+        "#section",
+        "#",
+        "",
+    ],
+)
+def test_join_url_matches_urljoin(url, link):
+    """
+    Check that `join_url` resolves links the same way `urljoin` does.
+    """
+    assert join_url(url, urlsplit(url), link) == urljoin(url, link)
+
+
+def test_wait_for_host_throttles_requests(mocker):
+    """
+    Check that requests to the same host beyond the per-second limit are
+    delayed, while other hosts are not affected.
+    """
+    mocker.patch("crawl.MAX_REQUESTS_PER_SECOND_PER_HOST", 2)
+    mocker.patch("crawl.time.monotonic", return_value=100.0)
+    mock_sleep = mocker.patch("crawl.time.sleep")
+    for _ in range(3):
+        wait_for_host("http://throttled.example.com/page.html")
+    wait_for_host("http://other.example.com/page.html")
+    assert [call.args[0] for call in mock_sleep.call_args_list] == [0, 0, 1, 0]
+
+
 def test_save_pages_locally(requests_mock, mocker):
     """
     Verify that `save_pages_locally` correctly saves page content to local files and handles duplicate page URLs.
@@ -102,20 +298,25 @@ def test_save_pages_locally(requests_mock, mocker):
 
     # mock open
     mock_open_function = mocker.patch("builtins.open", mocker.mock_open())
+    # nothing is written, so there is no temporary file to move into place
+    mocker.patch("pathlib.Path.replace")
 
     pages = [
-        {
-            "url": "http://example.com/page1.html",
-            "depth": 1,
-        },
-        {
-            "url": "http://example.com/page1.html",  # duplicate
-            "depth": 1,
-        },
-        {
-            "url": "http://example.com/page2.html",
-            "depth": 1,
-        },
+        PageRef(
+            url="http://example.com/page1.html",
+            page="http://example.com/testpage.html",
+            depth=1,
+        ),
+        PageRef(
+            url="http://example.com/page1.html",  # duplicate
+            page="http://example.com/testpage.html",
+            depth=1,
+        ),
+        PageRef(
+            url="http://example.com/page2.html",
+            page="http://example.com/testpage.html",
+            depth=1,
+        ),
     ]
     # this should now use the mocked open and not actually write files
     save_pages_locally(pages)
@@ -126,6 +327,138 @@ def test_save_pages_locally(requests_mock, mocker):
     assert mock_open_function.call_count == 2  # 2 unique pages
 
 
+def test_save_pages_locally_reuses_fetched_pages(mock_response, mocker):
+    """
+    Verify that `save_pages_locally` doesn't download pages again that were
+    already fetched while crawling.
+    """
+    mock_open_function = mocker.patch("builtins.open", mocker.mock_open())
+    mocker.patch("pathlib.Path.replace")
+    with requests_mock.Mocker() as m:
+        m.get("http://example.com/testpage.html", text=mock_response)
+        m.get("http://example.com/page1.html", text="<html>Page 1 content</html>")
+        m.get("http://example.com/page2.html", text="<html>Page 2 content</html>")
+        m.get("http://example.com/page3.html", text="<html>Page 3 content</html>")
+        m.get("http://example.com/nextpage.html", text=mock_response)
+        page_contents = {}
+        pages = fetch_pages_from_url(
+            "http://example.com/testpage.html", 1, 2, page_contents
+        )
+        crawl_call_count = m.call_count
+        save_pages_locally(pages, page_contents)
+        # every saved page was fetched during the crawl
+        assert m.call_count == crawl_call_count
+    assert mock_open_function.call_count == 4
+
+
+def test_save_pages_locally_keeps_raw_bytes(tmp_path, monkeypatch):
+    """
+    Verify that saved pages are byte for byte what the server sent, both for
+    pages fetched while crawling and for pages downloaded when saving.
+    """
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "pages").mkdir()
+    # UTF-8 without a charset, which `requests` would decode as ISO-8859-1
+    page1_content = """
+    <html>
+        <body>
+            <p>Café</p>
+            <a href="/data.bin">Data</a>
+        </body>
+    </html>
+    """.encode()
+    data_content = bytes(range(256))
+    with requests_mock.Mocker() as m:
+        m.get(
+            "http://example.com/testpage.html",
+            text='<html><a href="/page1.html">Page 1</a></html>',
+            headers={"Content-Type": "text/html"},
+        )
+        m.get(
+            "http://example.com/page1.html",
+            content=page1_content,
+            headers={"Content-Type": "text/html"},
+        )
+        data = m.get(
+            "http://example.com/data.bin",
+            content=data_content,
+            headers={"Content-Type": "application/octet-stream"},
+        )
+        page_contents = {}
+        pages = fetch_pages_from_url(
+            "http://example.com/testpage.html", 1, 2, page_contents
+        )
+        save_pages_locally(pages, page_contents)
+        assert data.call_count == 1
+
+    assert (tmp_path / "pages" / "page1.html.html").read_bytes() == page1_content
+    assert (tmp_path / "pages" / "data.bin.html").read_bytes() == data_content
+
+
+def test_save_pages_locally_streams_large_files(tmp_path, monkeypatch, mocker):
+    """
+    Check that pages not fetched while crawling are saved in chunks, even
+    when they are larger than `MAX_CONTENT_BYTES`.
+    """
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "pages").mkdir()
+    mocker.patch("crawl.MAX_CONTENT_BYTES", 16)
+    mocker.patch("crawl.CHUNK_SIZE", 8)
+    large_content = b"<html>" + b"a" * 32 + b"</html>"
+    with requests_mock.Mocker() as m:
+        m.get("http://example.com/large.html", content=large_content)
+        m.get("http://example.com/missing.html", status_code=404)
+        save_pages_locally(
+            [
+                PageRef(
+                    url="http://example.com/large.html",
+                    page="http://example.com/testpage.html",
+                    depth=1,
+                ),
+                PageRef(
+                    url="http://example.com/missing.html",
+                    page="http://example.com/testpage.html",
+                    depth=1,
+                ),
+            ]
+        )
+    assert (tmp_path / "pages" / "large.html.html").read_bytes() == large_content
+    # failed downloads leave neither the page nor a temporary file behind
+    assert [path.name for path in (tmp_path / "pages").iterdir()] == ["large.html.html"]
+
+
+def test_fetch_html_content_encoding(requests_mock):
+    """
+    Check that the declared charset is used to decode a page, and UTF-8 if
+    there is none.
+    """
+    requests_mock.get(
+        "http://example.com/utf8.html",
+        content="<p>Café</p>".encode(),
+        headers={"Content-Type": "text/html"},
+    )
+    requests_mock.get(
+        "http://example.com/latin1.html",
+        content="<p>Café</p>".encode("latin-1"),
+        headers={"Content-Type": "text/html; charset=ISO-8859-1"},
+    )
+    for url in ["http://example.com/utf8.html", "http://example.com/latin1.html"]:
+        assert fetch_html_content(url).text() == "<p>Café</p>"
+
+
+def test_open_atomically_replaces_file(tmp_path):
+    """
+    Check that `open_atomically` overwrites an existing file without leaving
+    the temporary file behind.
+    """
+    file_path = tmp_path / "page.html"
+    file_path.write_bytes(b"<html>Old content</html>")
+    with open_atomically(file_path) as fp:
+        fp.write(b"<html>New content</html>")
+    assert file_path.read_bytes() == b"<html>New content</html>"
+    assert list(tmp_path.iterdir()) == [file_path]
+
+
 def test_save_pages_metadata(mocker, cleanup_pages_dir):
     """
     Verify that `save_pages_metadata` correctly saves page metadata to a JSON file.
@@ -138,27 +471,125 @@ def test_save_pages_metadata(mocker, cleanup_pages_dir):
     # mock open
     mock_open = mocker.mock_open()
     mocker.patch("builtins.open", mock_open)
+    mock_replace = mocker.patch("pathlib.Path.replace")
 
-    # mock json.dump
-    mock_json_dump = mocker.patch.object(json, "dump")
     pages = [
-        {
-            "url": "http://example.com/page1.html",
-            "depth": 1,
-        },
-        {
-            "url": "http://example.com/page2.html",
-            "depth": 1,
-        },
+        PageRef(
+            url="http://example.com/page1.html",
+            page="http://example.com/testpage.html",
+            depth=1,
+        ),
+        PageRef(
+            url="http://example.com/page2.html",
+            page="http://example.com/testpage.html",
+            depth=1,
+        ),
     ]
     save_pages_metadata(pages)
 
-    # Check if open was called with the correct arguments
+    # Check if the metadata was written to a temporary file that then
+    # replaced the metadata file
     expected_path = Path("pages/pages_metadata.json")
-    mock_open.assert_called_once_with(expected_path, "w")
+    tmp_path, mode = mock_open.call_args.args
+    assert tmp_path.parent == expected_path.parent
+    assert tmp_path.name.startswith(expected_path.name)
+    assert mode == "wb"
+    mock_replace.assert_called_once_with(expected_path)
 
-    # Check if json.dump was called with the correct arguments
-    expected_data = {"pages": pages}
-    mock_json_dump.assert_called_once_with(
-        expected_data, mock_open.return_value, indent=4
+    # Check if the serialized metadata was written to the file
+    expected_data = {"pages": [page._asdict() for page in pages]}
+    written = b"".join(
+        call.args[0] for call in mock_open.return_value.write.call_args_list
     )
+    assert written == orjson.dumps(expected_data, option=orjson.OPT_INDENT_2)
+
+
+def test_save_pages_metadata_replaces_stale_metadata(tmp_path, monkeypatch):
+    """
+    Verify that `save_pages_metadata` doesn't leave metadata from a previous
+    run behind, neither for an empty crawl nor when the format changes.
+    """
+    pq = pytest.importorskip("pyarrow.parquet")
+    monkeypatch.chdir(tmp_path)
+    pages = [
+        PageRef(
+            url="http://example.com/page1.html",
+            page="http://example.com/testpage.html",
+            depth=1,
+        ),
+    ]
+    json_path = tmp_path / "pages" / "pages_metadata.json"
+    parquet_path = tmp_path / "pages" / "pages_metadata.parquet"
+
+    save_pages_metadata(pages)
+    save_pages_metadata([])
+    assert orjson.loads(json_path.read_bytes()) == {"pages": []}
+    assert json_path.read_bytes() == orjson.dumps(
+        {"pages": []}, option=orjson.OPT_INDENT_2
+    )
+
+    save_pages_metadata(pages, "parquet")
+    assert not json_path.exists()
+    save_pages_metadata([], "parquet")
+    assert pq.read_table(parquet_path).num_rows == 0
+    save_pages_metadata(pages)
+    assert not parquet_path.exists()
+
+
+def test_save_pages_metadata_parquet(tmp_path, monkeypatch):
+    """
+    Verify that `save_pages_metadata` can save page metadata to a Parquet file.
+    """
+    pq = pytest.importorskip("pyarrow.parquet")
+    monkeypatch.chdir(tmp_path)
+    pages = [
+        PageRef(
+            url="http://example.com/page1.html",
+            page="http://example.com/testpage.html",
+            depth=1,
+        ),
+        PageRef(
+            url="http://example.com/page2.html",
+            page="http://example.com/testpage.html",
+            depth=1,
+        ),
+    ]
+    save_pages_metadata(pages, "parquet")
+
+    table = pq.read_table(tmp_path / "pages" / "pages_metadata.parquet")
+    assert table.to_pylist() == [page._asdict() for page in pages]
+
+
+def test_save_pages_metadata_unknown_format(mocker):
+    """
+    Verify that `save_pages_metadata` rejects unknown formats instead of
+    falling back to JSON.
+    """
+    mock_mkdir = mocker.patch("pathlib.Path.mkdir")
+    with pytest.raises(ValueError, match="csv"):
+        save_pages_metadata([], "csv")
+    mock_mkdir.assert_not_called()
+
+
+def test_save_pages_metadata_parquet_without_pyarrow(tmp_path, monkeypatch, mocker):
+    """
+    Verify that `save_pages_metadata` explains how to install pyarrow when
+    Parquet output is asked for without it, and keeps the existing metadata.
+    """
+    monkeypatch.chdir(tmp_path)
+    save_pages_metadata([])
+    # a None entry makes importing the module fail
+    mocker.patch.dict(sys.modules, {"pyarrow": None, "pyarrow.parquet": None})
+    with pytest.raises(ImportError, match="poetry install --extras parquet"):
+        save_pages_metadata([], "parquet")
+    assert (tmp_path / "pages" / "pages_metadata.json").exists()
+
+
+def test_pyarrow_not_imported_by_default():
+    """
+    Check that importing the crawler doesn't load pyarrow, which is only
+    needed for Parquet output.
+    """
+    code = "import sys, crawl; sys.exit('pyarrow' in sys.modules)"
+    repo_dir = Path(__file__).parent.parent
+    assert subprocess.run([sys.executable, "-c", code], cwd=repo_dir).returncode == 0